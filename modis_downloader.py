@@ -18,11 +18,15 @@
 # along with modis_downloader.  If not, see <http://www.gnu.org/licenses/>.
 import optparse
 import os
+import json
+import threading
 import datetime
-import time
 import re
+import queue
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from pathlib import Path
 from concurrent import futures
@@ -69,8 +73,15 @@ logging.basicConfig(level=logging.DEBUG,
                     )
 LOG = logging.getLogger(__name__)
 BASE_URL = "http://e4ftl01.cr.usgs.gov/"
+# Size of the blocks used when streaming granules to disk (1 MiB)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 product_regex = r"M[CYO]D\d\dA.+?(?=.)\d\d\d"
+# Links in the Apache directory listings to date folders and HDF granules
+_DATE_RE = re.compile(r'href="(\d{4}\.\d{2}\.\d{2})/"')
+_HDF_RE = re.compile(r'href="([^"]+\.hdf)"')
+# Acquisition date (year and day of year) embedded in granule filenames
+_DATE_TOKEN_RE = re.compile(r"\.(A\d{7})\.")
 
 class WebError(RuntimeError):
     """An exception for web issues"""
@@ -79,96 +90,340 @@ class WebError(RuntimeError):
         self.args = arg
 
 
-def get_available_dates(url, start_date, end_date=None):
+class EarthdataSession(requests.Session):
+    """A ``requests.Session`` that keeps the user's credentials when the
+    data server redirects to the NASA Earthdata login server. By default,
+    ``requests`` drops the ``Authorization`` header on any redirect to a
+    different host, which would force us to resolve the login URL first
+    and then request it again.
+    """
+
+    AUTH_HOST = "urs.earthdata.nasa.gov"
+
+    def rebuild_auth(self, prepared_request, response):
+        headers = prepared_request.headers
+        url = prepared_request.url
+        if "Authorization" in headers:
+            original = requests.utils.urlparse(response.request.url).hostname
+            redirect = requests.utils.urlparse(url).hostname
+            if (
+                original != redirect
+                and redirect != self.AUTH_HOST
+                and original != self.AUTH_HOST
+            ):
+                del headers["Authorization"]
+
+
+def get_session(username, password, n_threads=5):
+    """Create a ``requests.Session`` that is shared by all the requests
+    made to the NASA server, so that connections are kept alive and
+    reused rather than opened afresh for every listing and granule.
+    """
+    session = EarthdataSession()
+    session.auth = (username, password)
+    session.headers["User-Agent"] = "modis_downloader/" + __version__
+    adapter = HTTPAdapter(
+        pool_connections=n_threads,
+        pool_maxsize=n_threads,
+        max_retries=Retry(
+            total=5,
+            connect=5,
+            read=3,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ListingCache:
+    """Remembers the ``ETag``/``Last-Modified`` headers and the parsed
+    links of the directory listings we've seen, stored as JSON in
+    ``fname``. On later runs, listings are requested conditionally and,
+    if the server replies ``304 Not Modified``, the links are taken from
+    the cache rather than downloaded and parsed again. Safe to share
+    between threads.
+    """
+
+    def __init__(self, fname):
+        self.fname = Path(fname)
+        self.lock = threading.Lock()
+        try:
+            self.entries = json.loads(self.fname.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def conditional_headers(self, url):
+        """Headers to make a conditional request for ``url``."""
+        with self.lock:
+            entry = self.entries.get(url, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def links(self, url):
+        with self.lock:
+            return self.entries[url]["links"]
+
+    def update(self, url, headers, links):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        with self.lock:
+            if etag or last_modified:
+                self.entries[url] = {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "links": links,
+                }
+            else:
+                self.entries.pop(url, None)
+
+    def save(self):
+        with self.lock:
+            tmp_fname = self.fname.with_name(self.fname.name + ".tmp")
+            tmp_fname.write_text(json.dumps(self.entries))
+            os.replace(tmp_fname, self.fname)
+
+
+def get_listing(session, url, link_re, cache=None):
+    """Gets an Apache directory listing and returns the links in it that
+    match ``link_re``. If a ``ListingCache`` is given, the request is
+    made conditional on the listing having changed. Returns ``None`` if
+    the listing couldn't be retrieved."""
+    headers = {} if cache is None else cache.conditional_headers(url)
+    # Transient failures are retried with backoff by the session itself
+    r = session.get(url, headers=headers, timeout=(10, 60))
+    if r.status_code == 304:
+        return cache.links(url)
+    if not r.ok:
+        return None
+    links = link_re.findall(r.text)
+    if cache is not None:
+        cache.update(url, r.headers, links)
+    return links
+
+
+def get_available_dates(session, url, start_date, end_date=None, cache=None):
     """
     This function gets the available dates for a particular
     product, and returns the ones that fall within a particular
     pair of dates. If the end date is set to ``None``, it will
     be assumed it is today.
     """
+    # The archive has daily granularity, so compare dates rather than times
     if end_date is None:
-        end_date = datetime.datetime.now()
-    r = requests.get(url)
-    if not r.ok:
+        end_date = datetime.date.today()
+    elif isinstance(end_date, datetime.datetime):
+        end_date = end_date.date()
+    if isinstance(start_date, datetime.datetime):
+        start_date = start_date.date()
+    dates = get_listing(session, url, _DATE_RE, cache=cache)
+    if dates is None:
         raise WebError(
             "Problem contacting NASA server. Either server "
             + "is down, or the product you used (%s) is kanckered" % url
         )
-    html = r.text
     avail_dates = []
-    for line in html.splitlines()[19:]:
-        if line.find("[DIR]") >= 0 and line.find("href") >= 0:
-            this_date = line.split("href=")[1].split('"')[1].strip("/")
-            this_datetime = datetime.datetime.strptime(this_date, "%Y.%m.%d")
-            if this_datetime >= start_date and this_datetime <= end_date:
-                avail_dates.append(url + "/" + this_date)
+    for this_date in dates:
+        year, month, day = this_date.split(".")
+        this_datetime = datetime.date(int(year), int(month), int(day))
+        if start_date <= this_datetime <= end_date:
+            avail_dates.append(url + "/" + this_date)
     return avail_dates
 
 
-def download_granule_list(url, tiles):
+def download_granule_list(session, url, tiles, cache=None):
     """For a particular product and date, obtain the data granule URLs.
 
     """
     
     if not isinstance(tiles, type([])):
         tiles = [tiles]
-    while True:
-        try:
-            r = requests.get(url)
-            break
-        except requests.execeptions.ConnectionError:
-            time.sleep(240)
+    fnames = get_listing(session, url, _HDF_RE, cache=cache)
+    if fnames is None:
+        raise WebError("Problem getting the granule list from %s" % url)
 
+    tile_re = re.compile("|".join(re.escape(tile) for tile in tiles))
     grab = []
-    for line in r.text.splitlines():
-        for tile in tiles:
-            if (
-                line.find(tile) >= 0
-                and line.find(".xml") < 0
-                and line.find("BROWSE") < 0
-            ):
-                fname = line.split("href=")[1].split('"')[1]
-                grab.append(url + "/" + fname)
+    for fname in fnames:
+        if "BROWSE" not in fname and tile_re.search(fname):
+            grab.append(url + "/" + fname)
     return grab
 
 
+def preallocate(fp, size):
+    """Reserve ``size`` bytes on disk for the open file ``fp`` in one go,
+    so the filesystem doesn't have to grow it block by block as data
+    arrives. ``posix_fallocate`` isn't available everywhere (e.g. Windows
+    or macOS), nor supported by every filesystem, in which case we just
+    set the file size."""
+    try:
+        os.posix_fallocate(fp.fileno(), 0, size)
+    except (AttributeError, OSError):
+        fp.truncate(size)
+
+
+def stream_to_file(raw, fp, chunk_size=DOWNLOAD_CHUNK_SIZE, queue_size=8):
+    """Copies the contents of the file-like ``raw`` into ``fp``. Writing
+    happens in a separate thread fed through a bounded queue, so that we
+    keep draining the socket while the disk is busy."""
+    blocks = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def writer():
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            # After a failure, keep emptying the queue so the reader
+            # doesn't block, but don't write anything else
+            if not errors:
+                try:
+                    fp.write(block)
+                except Exception as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        while not errors:
+            block = raw.read(chunk_size)
+            if not block:
+                break
+            blocks.put(block)
+    finally:
+        blocks.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 def download_granules(url, session, username, password, output_dir):
 
-    r1 = session.request("get", url)
-    r = session.get(r1.url, stream=True)
-    fname = url.split("/")[-1]
-    LOG.debug("Getting %s from %s(-> %s)" % (fname, url, r1.url))
-    if not r.ok:
-        raise IOError("Can't start download... [%s]" % fname)
-    file_size = int(r.headers["content-length"])
-    LOG.debug("\t%s file size: %d" % (fname, file_size))
-    output_fname = os.path.join(output_dir, fname)
-    # Save with temporary filename...
-    with open(output_fname + ".partial", "wb") as fp:
-        for block in r.iter_content(65536):
-            fp.write(block)
+    fname = url.rpartition("/")[2]
+    output_fname = Path(output_dir, fname)
+    partial_fname = Path(output_dir, fname + ".partial")
+    etag_fname = Path(output_dir, fname + ".etag")
+    # If a previous attempt left a partial file behind, ask the server for
+    # the remaining bytes only. ``If-Range`` makes the server send the whole
+    # file instead if it has changed since the partial file was started.
+    headers = {}
+    offset = 0
+    if partial_fname.exists() and etag_fname.exists():
+        validator = etag_fname.read_text().strip()
+        offset = partial_fname.stat().st_size
+        if validator and offset > 0:
+            headers = {"Range": f"bytes={offset:d}-", "If-Range": validator}
+    # A single streamed GET follows the redirect through the login server
+    # and back, so there is no need for a separate request to resolve it.
+    get_granule = partial(
+        session.get,
+        url,
+        stream=True,
+        allow_redirects=True,
+        timeout=(10, 120),
+    )
+    r = get_granule(headers=headers)
+    if headers and (
+        r.status_code == 416
+        or (
+            r.status_code == 206
+            and not r.headers.get("Content-Range", "").startswith(
+                f"bytes {offset:d}-"
+            )
+        )
+    ):
+        # The partial file can't be resumed from (e.g. the process was
+        # killed while it was still preallocated to its full size), so
+        # throw it away and get the whole file instead
+        LOG.debug("\tCan't resume %s, starting afresh" % fname)
+        r.close()
+        partial_fname.unlink()
+        etag_fname.unlink()
+        offset = 0
+        r = get_granule()
+    with r:
+        LOG.debug("Getting %s from %s(-> %s)" % (fname, url, r.url))
+        if not r.ok:
+            raise IOError("Can't start download... [%s]" % fname)
+        if r.status_code == 206:
+            LOG.debug("\tResuming %s from byte %d" % (fname, offset))
+            mode = "r+b"
+        else:
+            offset = 0
+            mode = "wb"
+            validator = r.headers.get("ETag") or r.headers.get(
+                "Last-Modified", ""
+            )
+            etag_fname.write_text(validator)
+        file_size = offset + int(r.headers["content-length"])
+        LOG.debug("\t%s file size: %d" % (fname, file_size))
+        # Save with temporary filename. Granules are served without a
+        # content encoding, so the raw socket stream is written as is.
+        r.raw.decode_content = False
+        with open(partial_fname, mode, buffering=DOWNLOAD_CHUNK_SIZE) as fp:
+            preallocate(fp, file_size)
+            fp.seek(offset)
+            try:
+                stream_to_file(r.raw, fp)
+            finally:
+                # Drop the preallocated tail if we didn't get everything,
+                # so the partial file can be resumed from where it stopped.
+                if fp.tell() != file_size:
+                    fp.truncate()
+            if fp.tell() != file_size:
+                raise IOError(
+                    "Incomplete download... [%s] (%d of %d bytes)"
+                    % (fname, fp.tell(), file_size)
+                )
     # Rename to definitive filename
-    os.rename(output_fname + ".partial", output_fname)
+    os.replace(partial_fname, output_fname)
+    etag_fname.unlink()
     LOG.info("Done with %s" % output_fname)
-    return output_fname
-
-
-def required_files(url_list, output_dir):
-    """Checks for files that are already available in the system."""
-
-    all_files_present = os.listdir(output_dir)
-    hdf_files_present = [
-        fich for fich in all_files_present if fich.endswith(".hdf")
-    ]
-    hdf_files_present = set(hdf_files_present)
-
-    flist = [url.split("/")[-1] for url in url_list]
-    file_list = dict(list(zip(flist, url_list)))
-
-    flist = set(flist)
-    files_to_download = list(flist.difference(hdf_files_present))
-    to_download = [file_list[k] for k in files_to_download]
-    return to_download
+    return str(output_fname)
+
+
+def existing_granules(output_dir):
+    """Returns the set of HDF granule filenames already in ``output_dir``."""
+    return {
+        entry.name
+        for entry in os.scandir(output_dir)
+        if entry.name.endswith(".hdf")
+    }
+
+
+def granules_by_date(fnames, product):
+    """Groups the granule filenames for ``product`` (e.g. ``MOD13A2.006``)
+    by the ``AYYYYDDD`` acquisition date token that is embedded in MODIS
+    filenames. Granules of other products or collections are ignored."""
+    short_name, collection = product.split(".", 1)
+    by_date = {}
+    for fname in fnames:
+        if not (
+            fname.startswith(f"{short_name}.A")
+            and f".{collection}." in fname
+        ):
+            continue
+        match = _DATE_TOKEN_RE.search(fname)
+        if match is not None:
+            by_date.setdefault(match.group(1), []).append(fname)
+    return by_date
+
+
+def have_all_tiles(date_url, tiles, by_date):
+    """Checks whether granules for all ``tiles`` are already present for
+    the archive folder ``date_url`` (ending in ``YYYY.MM.DD``), so that
+    its listing doesn't need to be fetched at all."""
+    year, month, day = date_url.rpartition("/")[2].split(".")
+    token = datetime.date(int(year), int(month), int(day)).strftime("A%Y%j")
+    present = by_date.get(token, [])
+    return all(any(tile in fname for fname in present) for tile in tiles)
 
 
 def get_modis_data(
@@ -221,66 +476,130 @@ def get_modis_data(
     )
     # If output directory doesn't exist, create it
     LOG.debug(f"Creating output folder {output_dir:s}")
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if not isinstance(tiles, type([])):
+        tiles = [tiles]
+    # Check what we already have, so we only ask the server about dates
+    # for which some of the tiles are missing
+    existing = existing_granules(output_dir)
+    by_date = granules_by_date(existing, product)
     # Cook the URL for the product
     url = BASE_URL + platform + "/" + product
-    # Get all the available dates in the NASA archive...
-    LOG.debug("Getting available dates from NASA server...")
-    the_dates = get_available_dates(url, start_date, end_date=end_date)
-    LOG.debug(f"{len(the_dates):d} available...")
-    LOG.debug(f"First:{str(the_dates[0]):s}")
-    LOG.debug(f"Last:{str(the_dates[-1]):s}")
-    # We then explore the NASA archive for the dates that we are going to
-    # download. This is done in parallel. For each date, we will get the
-    # url for each of the tiles that are required.
-    the_granules = []
-    download_granule_patch = partial(download_granule_list, tiles=tiles)
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        for granules in executor.map(download_granule_patch, the_dates):
-            the_granules.append(granules)
-    # Flatten the list of lists...
-    gr = [g for granule in the_granules for g in granule]
-    gr.sort()
-    LOG.info(f"Found {len(gr):d} remote granules.")
-    # Check whether we have some files available already
-    gr_to_dload = required_files(gr, output_dir)
-    gr = gr_to_dload
-    req_fnames = [fich.split("/")[-1] for fich in gr]
-    LOG.info("Will download %d files" % len(gr))
-    if len(gr) == 0:
-        LOG.info("Done")
-        return []
-    have_all_files = False
-    while not have_all_files:
-        # Wait for a few minutes before downloading the data
-        time.sleep(10)
-        # The main download loop. This will get all the URLs with the filenames,
-        # and start downloading them in parallel.
+    # Directory listings rarely change, so remember them between runs
+    cache = ListingCache(Path(output_dir, ".listing_cache.json"))
+    # Listings are small HTML pages, so we can afford many more of them in
+    # flight than actual granule downloads.
+    n_listing_threads = 4 * n_threads
+    # A single session is used for everything, so that connections to the
+    # server are reused across listings and downloads.
+    with get_session(username, password, n_threads=n_listing_threads) as s:
+        # Get all the available dates in the NASA archive...
+        LOG.debug("Getting available dates from NASA server...")
+        the_dates = get_available_dates(
+            s, url, start_date, end_date=end_date, cache=cache
+        )
+        LOG.debug(f"{len(the_dates):d} available...")
+        LOG.debug(f"First:{str(the_dates[0]):s}")
+        LOG.debug(f"Last:{str(the_dates[-1]):s}")
+        n_dates = len(the_dates)
+        the_dates = [
+            the_date
+            for the_date in the_dates
+            if not have_all_tiles(the_date, tiles, by_date)
+        ]
+        LOG.debug(
+            f"{n_dates - len(the_dates):d} dates already fully downloaded..."
+        )
+        # We then explore the NASA archive for the dates that we are going to
+        # download. This is done in parallel. For each date, we will get the
+        # url for each of the tiles that are required. As soon as a listing
+        # arrives, any granules we don't already have are queued for
+        # download, so downloads start while other listings are in flight.
+        n_remote = 0
+        req_fnames = []
+        dload_futures = set()
+        download_granule_patch = partial(
+            download_granules,
+            session=s,
+            output_dir=output_dir,
+            username=username,
+            password=password,
+        )
+        # Only keep a few downloads queued up beyond those in progress, so
+        # huge requests don't pile up pending futures
+        dload_slots = threading.BoundedSemaphore(4 * n_threads)
         dload_files = []
-        with requests.Session() as s:
-            s.auth = (username, password)
-            download_granule_patch = partial(
-                download_granules,
-                session=s,
-                output_dir=output_dir,
-                username=username,
-                password=password,
-            )
 
-            with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-                for fich in executor.map(download_granule_patch, gr):
-                    dload_files.append(fich)
-        
+        def collect(dload_future):
+            # ``result`` re-raises any error from the download
+            dload_files.append(dload_future.result())
+            LOG.debug(f"{len(dload_files):d}/{len(req_fnames):d} downloaded")
+
+        with futures.ThreadPoolExecutor(
+            max_workers=n_listing_threads
+        ) as list_executor, futures.ThreadPoolExecutor(
+            max_workers=n_threads
+        ) as dload_executor:
+            list_futures = [
+                list_executor.submit(
+                    download_granule_list, s, the_date, tiles, cache=cache
+                )
+                for the_date in the_dates
+            ]
+            try:
+                # Watch listings and downloads together, so that a failed
+                # download is noticed while listings are still coming in
+                pending_lists = set(list_futures)
+                while pending_lists:
+                    done, _ = futures.wait(
+                        pending_lists | dload_futures,
+                        return_when=futures.FIRST_COMPLETED,
+                    )
+                    for fut in done:
+                        if fut not in pending_lists:
+                            dload_futures.remove(fut)
+                            collect(fut)
+                            continue
+                        pending_lists.remove(fut)
+                        for granule in sorted(fut.result()):
+                            n_remote += 1
+                            fname = granule.rpartition("/")[2]
+                            if fname in existing:
+                                continue
+                            req_fnames.append(fname)
+                            dload_slots.acquire()
+                            dload_future = dload_executor.submit(
+                                download_granule_patch, granule
+                            )
+                            dload_future.add_done_callback(
+                                lambda _: dload_slots.release()
+                            )
+                            dload_futures.add(dload_future)
+                cache.save()
+                LOG.info(f"Found {n_remote:d} remote granules.")
+                LOG.info("Will download %d files" % len(req_fnames))
+                # Collect the remaining downloads as they finish, so one
+                # slow granule doesn't hold up the rest
+                for dload_future in futures.as_completed(dload_futures):
+                    collect(dload_future)
+            except BaseException:
+                # Don't start anything else if something went wrong or the
+                # user has had enough (Ctrl-C)
+                for fut in list_futures + list(dload_futures):
+                    fut.cancel()
+                raise
+        if len(req_fnames) == 0:
+            LOG.info("Done")
+            return []
+        dload_files.sort()
         gotten_files = [Path(fich).name for fich in dload_files]
-        if all(fich in gotten_files  for fich in req_fnames):
-            have_all_files = True
+        if all(fich in gotten_files for fich in req_fnames):
             LOG.info(f"{len(gotten_files):d} were successfully downloaded!")
         else:
             raise IOError("Not all files were succesfully downloaded!\n" +
                     "Try the command again to complete file downloading")
-        
-    return dload_files
+
+        return dload_files
 
 def main():
     parser = optparse.OptionParser(formatter=optparse.TitledHelpFormatter(),